@@ -1,17 +1,65 @@
 import os
+import re
 import uuid
-import json
-import requests
 import time
-from datetime import datetime, timedelta
-from flask import Flask, request, jsonify
+import random
+import heapq
+import hashlib
+import functools
+import sqlite3
+from collections import Counter, defaultdict, deque
+import asyncio
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime
+from quart import Quart, request, jsonify
+from quart.json.provider import DefaultJSONProvider
+from werkzeug.exceptions import HTTPException
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+import aiohttp
+import orjson
+import atexit
+import queue
 import logging
+from logging.handlers import QueueHandler, QueueListener
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+try:
+    import uvloop
+except ImportError:  # uvloop is not available on Windows
+    uvloop = None
+
+# Configure logging (DEBUG_MODE adds per-request and per-message detail, LOG_LEVEL overrides it)
+DEBUG_MODE = os.getenv("DEBUG_MODE", "false").lower() in ("1", "true", "yes")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG" if DEBUG_MODE else "INFO").upper()
+# Log calls only enqueue records; a background thread writes them out
+log_queue = queue.SimpleQueue()
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(log_queue)])
+log_listener = QueueListener(log_queue, logging.StreamHandler())
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
+if not isinstance(logging.getLevelName(LOG_LEVEL), int):
+    logger.warning("⚠️ Unknown LOG_LEVEL %r, using INFO", LOG_LEVEL)
+    LOG_LEVEL = "INFO"
+logger.setLevel(LOG_LEVEL)
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Quart JSON provider that encodes and decodes with orjson"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=self.default), mimetype=self.mimetype)
 
-app = Flask(__name__)
+app = Quart(__name__)
+app.json = OrjsonProvider(app)
+app.config["MAX_CONTENT_LENGTH"] = 64 * 1024  # Hard cap on any request body
 
 # Environment variables (to be set in Render)
 DISCORD_COOKIE = os.getenv("DISCORD_COOKIE")
@@ -20,73 +68,457 @@ DISCORD_SUPER_PROPERTIES = os.getenv("DISCORD_SUPER_PROPERTIES")
 GUILD_ID = os.getenv("GUILD_ID")
 CHANNEL_ID = os.getenv("CHANNEL_ID", "1388899115647111304")  # Your channel ID
 MAX_WAIT_MINUTES = int(os.getenv("MAX_WAIT_MINUTES", "15"))
+# Seconds between channel checks: start slow (Midjourney rarely answers within 20s),
+# speed up while Midjourney is posting and back off again while it is quiet
+CHECK_INTERVAL = float(os.getenv("CHECK_INTERVAL", "15"))
+MIN_CHECK_INTERVAL = 2.0
+MAX_CHECK_INTERVAL = 20.0
+MAX_BATCH_STATUS = 500  # Most task IDs accepted by /status/batch
+MAX_STATUS_WAIT = 55  # Longest /status long-poll in seconds, below typical proxy timeouts
+MAX_GENERATE_BYTES = 16 * 1024  # A prompt is at most 2000 characters
+MAX_SEND_ATTEMPTS = 5  # Attempts per /imagine command on 429, 5xx or network errors
+MAX_CONCURRENT_SENDS = int(os.getenv("MAX_CONCURRENT_SENDS", "10"))  # Interaction POSTs in flight at once
+
+# The environment is fixed for the life of the process, so validate it once
+MISSING_ENV_VARS = [
+    name for name, value in (
+        ("DISCORD_COOKIE", DISCORD_COOKIE),
+        ("GUILD_ID", GUILD_ID),
+        ("CHANNEL_ID", CHANNEL_ID),
+        ("DISCORD_SUPER_PROPERTIES", DISCORD_SUPER_PROPERTIES)
+    ) if not value
+]
+CONFIGURED = bool(DISCORD_COOKIE and GUILD_ID and CHANNEL_ID)
 
 # Midjourney Bot Application ID (official)
 MIDJOURNEY_APP_ID = "936929561302675456"
 IMAGINE_COMMAND_ID = "938956540159881230"
 IMAGINE_COMMAND_VERSION = "1118961510123847772"
+# The Midjourney bot user shares its ID with the application
+MIDJOURNEY_USER_ID = MIDJOURNEY_APP_ID
+DISCORD_EPOCH_MS = 1420070400000
+
+TOKEN_RE = re.compile(r"\w+")
+BOLD_PROMPT_RE = re.compile(r"\*\*(.+?)\*\*")  # Midjourney echoes the prompt as **prompt**
+IMAGE_FILENAME_RE = re.compile(r"\.(?:png|jpe?g|webp)$", re.IGNORECASE)
+
+MESSAGES_URL = f"https://discord.com/api/v9/channels/{CHANNEL_ID}/messages"
+MESSAGES_PAGE_SIZE = 100  # Discord's maximum per request
+
+# Static request headers for the Discord API (all values come from the environment)
+HEADERS = {
+    "authority": "discord.com",
+    "accept": "*/*",
+    "accept-language": "en-US,en;q=0.9",
+    "content-type": "application/json",
+    "origin": "https://discord.com",
+    "referer": f"https://discord.com/channels/{GUILD_ID}/{CHANNEL_ID}",
+    "user-agent": DISCORD_USER_AGENT,
+    "cookie": DISCORD_COOKIE,
+    "x-super-properties": DISCORD_SUPER_PROPERTIES,
+    "x-discord-locale": "en-US"
+}
+# aiohttp rejects None header values, so drop unset ones
+HEADERS = {k: v for k, v in HEADERS.items() if v is not None}
+
+# Static skeleton of the /imagine interaction payload
+PAYLOAD_TEMPLATE = {
+    "type": 2,  # APPLICATION_COMMAND
+    "application_id": MIDJOURNEY_APP_ID,
+    "guild_id": GUILD_ID,
+    "channel_id": CHANNEL_ID,
+    "session_id": None,
+    "data": {
+        "version": IMAGINE_COMMAND_VERSION,
+        "id": IMAGINE_COMMAND_ID,
+        "name": "imagine",
+        "type": 1,
+        "options": [],
+        "application_command": {
+            "id": IMAGINE_COMMAND_ID,
+            "application_id": MIDJOURNEY_APP_ID,
+            "version": IMAGINE_COMMAND_VERSION,
+            "default_member_permissions": None,
+            "type": 1,
+            "nsfw": False,
+            "name": "imagine",
+            "description": "Create images with Midjourney",
+            "dm_permission": True,
+            "options": [
+                {
+                    "type": 3,
+                    "name": "prompt",
+                    "description": "A prompt to generate an image.",
+                    "required": True
+                }
+            ]
+        },
+        "attachments": []
+    }
+}
+
+@dataclass(slots=True)
+class Task:
+    """A submitted /imagine prompt and, once Midjourney replies, its result"""
+    task_id: str
+    prompt: str
+    status: str
+    created_at: datetime
+    created_monotonic: float
+    message: str = ""
+    session_id: str = ""
+    error: str = ""
+    message_id: str | None = None
+    image_urls: list = field(default_factory=list)
+    completed_at: datetime | None = None
+    
+    def to_dict(self):
+        """Return the fields clients see for the task's current status"""
+        data = {"task_id": self.task_id, "status": self.status, "prompt": self.prompt}
+        if self.status == "completed":
+            data["message_id"] = self.message_id
+            data["image_urls"] = self.image_urls
+            data["completed_at"] = self.completed_at
+        elif self.error:
+            data["error"] = self.error
+        else:
+            data["message"] = self.message
+        return data
+
+class ExpiringDict:
+    """Dict whose entries expire after a fixed TTL, evicted by a background thread.
+    
+    Holds at most maxsize entries; inserting beyond that drops the oldest entry.
+    The eviction thread starts with the first insert, so unused stores cost nothing.
+    """
+    
+    def __init__(self, name, ttl, maxsize):
+        self._name = name  # Shown in eviction logs and the thread name
+        self._ttl = ttl
+        self._maxsize = maxsize
+        self._data = {}  # key -> (expires_at, value), in insertion (and so expiry) order
+        self._heap = []  # (expires_at, key), earliest expiry first
+        self._lock = threading.Lock()
+        self._evictor = None
+    
+    def __setitem__(self, key, value):
+        expires_at = time.monotonic() + self._ttl
+        with self._lock:
+            # Re-insert so the dict order keeps matching expiry order
+            self._data.pop(key, None)
+            while len(self._data) >= self._maxsize:
+                del self._data[next(iter(self._data))]
+            self._data[key] = (expires_at, value)
+            heapq.heappush(self._heap, (expires_at, key))
+            if self._evictor is None:
+                self._evictor = threading.Thread(target=self._evict_forever, name=f"{self._name}-expiry", daemon=True)
+                self._evictor.start()
+            # Drop heap entries for keys that were replaced or evicted early
+            if len(self._heap) > 2 * self._maxsize:
+                self._heap = [(exp, k) for k, (exp, _) in self._data.items()]
+                heapq.heapify(self._heap)
+    
+    def __getitem__(self, key):
+        return self._data[key][1]
+    
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
+    
+    def __contains__(self, key):
+        return key in self._data
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        return default if entry is None else entry[1]
+    
+    def pop(self, key, *default):
+        with self._lock:
+            if key in self._data:
+                return self._data.pop(key)[1]
+        if default:
+            return default[0]
+        raise KeyError(key)
+    
+    def items(self):
+        with self._lock:
+            return [(k, v) for k, (_, v) in self._data.items()]
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._heap.clear()
+    
+    def _evict_forever(self):
+        while True:
+            now = time.monotonic()
+            evicted = 0
+            with self._lock:
+                while self._heap and self._heap[0][0] <= now:
+                    expires_at, key = heapq.heappop(self._heap)
+                    # Skip heap entries left behind by a re-set or removed key
+                    entry = self._data.get(key)
+                    if entry is not None and entry[0] == expires_at:
+                        del self._data[key]
+                        evicted += 1
+            if evicted:
+                logger.info("🧹 Expired %d entries from %s", evicted, self._name)
+            time.sleep(1)
+
+# Task storage (timed-out tasks stay visible for an hour, results for a day)
+MAX_TASKS = int(os.getenv("MAX_TASKS", "10000"))
+pending_tasks = ExpiringDict("pending_tasks", ttl=MAX_WAIT_MINUTES * 60 + 3600, maxsize=MAX_TASKS)
+COMPLETED_TTL = 24 * 3600
+completed_tasks = ExpiringDict("completed_tasks", ttl=COMPLETED_TTL, maxsize=MAX_TASKS)
+
+# Optional SQLite file that keeps completed tasks across restarts (e.g. on a mounted disk)
+TASKS_DB = os.getenv("TASKS_DB")
+DB_LOCK = threading.Lock()
+
+def open_tasks_db(path):
+    """Open the completed-task database, creating its table on first use"""
+    db = sqlite3.connect(path, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS completed_tasks "
+        "(task_id TEXT PRIMARY KEY, record BLOB NOT NULL, completed_at REAL NOT NULL)"
+    )
+    # Every save prunes expired records by completed_at
+    db.execute("CREATE INDEX IF NOT EXISTS completed_tasks_completed_at ON completed_tasks (completed_at)")
+    return db
+
+tasks_db = open_tasks_db(TASKS_DB) if TASKS_DB else None
 
-# Task storage
-pending_tasks = {}
-completed_tasks = {}
+def save_completed_task(task):
+    """Write a completed task to the database and drop records past their TTL"""
+    now = time.time()
+    with DB_LOCK:
+        tasks_db.execute(
+            "INSERT OR REPLACE INTO completed_tasks VALUES (?, ?, ?)",
+            (task.task_id, orjson.dumps(task.to_dict()), now)
+        )
+        tasks_db.execute("DELETE FROM completed_tasks WHERE completed_at < ?", (now - COMPLETED_TTL,))
+        tasks_db.commit()
+
+def load_completed_tasks(task_ids):
+    """Return the stored records of whichever of the given tasks completed, keyed by task_id"""
+    cutoff = time.time() - COMPLETED_TTL
+    records = {}
+    with DB_LOCK:
+        for task_id in task_ids:
+            row = tasks_db.execute(
+                "SELECT record FROM completed_tasks WHERE task_id = ? AND completed_at >= ?",
+                (task_id, cutoff)
+            ).fetchone()
+            if row:
+                records[task_id] = orjson.loads(row[0])
+    return records
+
+# sha256 of a normalized prompt -> task_id of its latest submission, so repeats reuse finished images
+prompt_index = ExpiringDict("prompt_index", ttl=3600, maxsize=2048)
+# Caller-supplied task_id -> task_id of the task serving it, when /generate reused or joined another task
+task_aliases = ExpiringDict("task_aliases", ttl=COMPLETED_TTL, maxsize=MAX_TASKS)
+
+# Task state below is only touched from the one event loop, and no update awaits midway, so it needs no lock
+# (ExpiringDict guards itself against its eviction thread)
+
+# task_id -> (future, prompt word set); futures are resolved when Midjourney posts the result
+pending_futures = {}
+# prompt word -> ids of pending tasks whose prompt contains it, so a reply only checks tasks it shares words with
+token_index = defaultdict(set)
+# task_id -> asyncio.Event set once the task completes or times out (for /status long-polls)
+completion_events = {}
+# prompt hash -> (task_id, send task) while an /imagine command for that prompt is being sent
+submissions = {}
+_watcher = None
+channel_checks = 0  # Channel message fetches made by the watcher
+
+# Shared aiohttp session and background tasks, all on the server's event loop
+_background_tasks = set()
+SESSION = None
+# Bursts of /generate queue here rather than hitting Discord's rate limits all at once
+SEND_SLOTS = asyncio.Semaphore(MAX_CONCURRENT_SENDS)
+
+# Pre-generated interaction session IDs, only consumed on the event loop
+SESSION_ID_BATCH = 256
+_session_ids = deque()
+
+def spawn(coro):
+    """Schedule a coroutine on the running loop, keeping a reference and logging failures"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_on_background_task_done)
+    return task
+
+def _on_background_task_done(task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("❌ Background task %s failed: %r", task.get_coro().__name__, task.exception())
+
+def get_session():
+    """Return the shared aiohttp session, creating it on first use"""
+    global SESSION
+    if SESSION is None:
+        SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=200,
+                limit_per_host=50,  # Everything goes to discord.com
+                keepalive_timeout=75,
+                ttl_dns_cache=300,
+                enable_cleanup_closed=True
+            ),
+            timeout=aiohttp.ClientTimeout(total=15, connect=5)
+        )
+    return SESSION
+
+@app.before_serving
+async def warm_session():
+    """Open a pooled connection to Discord in the background so the first /generate skips DNS and TLS"""
+    if CONFIGURED:
+        spawn(warm_connection())
+
+async def warm_connection():
+    try:
+        async with get_session().head("https://discord.com/api/v9/gateway"):
+            pass
+        logger.debug("🔥 Discord connection warmed up")
+    except Exception as e:
+        logger.warning("⚠️ Could not warm up Discord connection: %s", e)
+
+@app.after_serving
+async def close_session():
+    """Close the shared aiohttp session when the server shuts down"""
+    if SESSION is not None and not SESSION.closed:
+        await SESSION.close()
+
+# The index document never changes, so serialize it once
+HOME_BODY = orjson.dumps({
+    "status": "✅ Midjourney Raw API Bridge is running",
+    "version": "2.0",
+    "method": "Raw Discord API calls",
+    "endpoints": ["/generate", "/status/<task_id>", "/status/batch", "/health"]
+})
 
 @app.route("/")
-def home():
-    return jsonify({
-        "status": "✅ Midjourney Raw API Bridge is running",
-        "version": "2.0",
-        "method": "Raw Discord API calls",
-        "endpoints": ["/generate", "/status/<task_id>", "/health"]
-    })
+async def home():
+    response = app.response_class(HOME_BODY, mimetype="application/json")
+    response.headers["Cache-Control"] = "public, max-age=300"
+    return response
 
 @app.route("/health")
-def health():
+async def health():
     return jsonify({
         "status": "healthy",
-        "configured": bool(DISCORD_COOKIE and GUILD_ID and CHANNEL_ID),
+        "configured": CONFIGURED,
         "pending_tasks": len(pending_tasks),
-        "completed_tasks": len(completed_tasks)
+        "completed_tasks": len(completed_tasks),
+        "channel_checks": channel_checks
     })
 
 @app.route("/generate", methods=["POST"])
-def generate():
+async def generate():
     """Generate image using raw Discord API to trigger Midjourney"""
     try:
-        data = request.get_json()
-        if not data:
+        # Reject oversized or malformed bodies before parsing them (chunked uploads carry no Content-Length)
+        if (request.content_length or 0) > MAX_GENERATE_BYTES or len(await request.get_data()) > MAX_GENERATE_BYTES:
+            return jsonify({"error": "Payload too large"}), 413
+        data = await request.get_json(silent=True, cache=False)
+        if not data or not isinstance(data, dict):
             return jsonify({"error": "JSON data required"}), 400
+        if not isinstance(data.get("prompt", ""), str):
+            return jsonify({"error": "Prompt must be a string"}), 400
+        requested_id = data.get("task_id")
+        if requested_id is not None and (not isinstance(requested_id, str) or not requested_id):
+            return jsonify({"error": "task_id must be a non-empty string"}), 400
             
         prompt = data.get("prompt", "").strip()
-        task_id = data.get("task_id", f"task_{int(time.time() * 1000)}")
+        # The random suffix keeps IDs from a burst within one millisecond apart
+        task_id = requested_id or f"task_{int(time.time() * 1000)}_{new_session_id()[:8]}"
         
         if not prompt:
             return jsonify({"error": "Prompt is required"}), 400
         
         # Validate required environment variables
-        missing_vars = []
-        if not DISCORD_COOKIE:
-            missing_vars.append("DISCORD_COOKIE")
-        if not GUILD_ID:
-            missing_vars.append("GUILD_ID")
-        if not CHANNEL_ID:
-            missing_vars.append("CHANNEL_ID")
-        if not DISCORD_SUPER_PROPERTIES:
-            missing_vars.append("DISCORD_SUPER_PROPERTIES")
-            
-        if missing_vars:
+        if MISSING_ENV_VARS:
             return jsonify({
-                "error": f"Missing environment variables: {', '.join(missing_vars)}"
+                "error": f"Missing environment variables: {', '.join(MISSING_ENV_VARS)}"
             }), 500
         
-        logger.info(f"🚀 Submitting prompt to Midjourney: {prompt}")
+        # Serve a retried task_id or a repeated prompt from the task that already generated it
+        prompt_key = prompt_hash(prompt)
+        # A task_id completed before a restart is only on disk; load it before the in-memory checks so no await splits them
+        stored = None
+        if tasks_db is not None and requested_id is not None and requested_id not in completed_tasks:
+            stored = (await asyncio.to_thread(load_completed_tasks, [requested_id])).get(requested_id)
+        
+        existing_id = task_aliases.get(task_id, task_id)
+        if existing_id not in completed_tasks and not task_in_flight(existing_id):
+            existing_id = prompt_index.get(prompt_key)
+        existing = completed_tasks.get(existing_id)
+        if stored is None and existing is not None:
+            stored = existing.to_dict()
+        if stored is not None:
+            logger.info("♻️ Reusing task %s for repeated request", stored["task_id"])
+            return jsonify({
+                "success": True,
+                **response_task_ids(requested_id, stored["task_id"]),
+                "status": "completed",
+                "message": "Prompt already generated",
+                "prompt": stored["prompt"],
+                "image_urls": stored["image_urls"]
+            })
+        
+        # ...or from the task still being sent or waiting on Midjourney for it
+        if task_in_flight(existing_id):
+            existing = pending_tasks[existing_id]
+            logger.info("♻️ Joining in-flight task %s for repeated request", existing_id)
+            return jsonify({
+                "success": True,
+                **response_task_ids(requested_id, existing_id),
+                "status": existing.status,
+                "message": "Prompt already in progress",
+                "prompt": existing.prompt
+            })
+        
+        # Send the imagine command, sharing one send between identical prompts arriving together
+        submission = submissions.get(prompt_key)
+        if submission is None:
+            logger.info("🚀 Submitting prompt to Midjourney: %s", prompt)
+            pending_tasks[task_id] = Task(
+                task_id=task_id,
+                prompt=prompt,
+                status="queued",
+                created_at=datetime.now(),
+                created_monotonic=time.monotonic(),
+                message="Waiting to be sent to Discord"
+            )
+            task_aliases.pop(task_id, None)
+            completion_events[task_id] = asyncio.Event()
+            submission = submissions[prompt_key] = (task_id, spawn(submit_prompt(prompt, task_id)))
+            submission[1].add_done_callback(lambda _: submissions.pop(prompt_key, None))
+        submitted_id, send = submission
+        task_ids = response_task_ids(requested_id, submitted_id)
+        
+        # ?async=1 returns as soon as the task is queued; /status reports how the send went
+        if request.args.get("async", "").lower() in ("1", "true", "yes"):
+            return jsonify({
+                "success": True,
+                **task_ids,
+                "status": "queued",
+                "message": "Command queued for Midjourney",
+                "prompt": prompt
+            }), 202
         
-        # Send the imagine command
-        success, message = send_imagine_command(prompt, task_id)
+        # Shield the send so a disconnecting client does not cancel it for the others
+        success, message = await asyncio.shield(send)
         
         if success:
             return jsonify({
                 "success": True,
-                "task_id": task_id,
+                **task_ids,
                 "status": "submitted",
                 "message": message,
                 "prompt": prompt
@@ -94,201 +526,477 @@ def generate():
         else:
             return jsonify({
                 "success": False,
-                "task_id": task_id,
+                **task_ids,
                 "status": "failed",
                 "error": message
             }), 400
             
+    except HTTPException as e:
+        # e.g. a body over MAX_CONTENT_LENGTH
+        return jsonify({"error": e.description}), e.code
     except Exception as e:
-        logger.error(f"❌ Error in /generate: {e}")
+        logger.error("❌ Error in /generate: %s", e)
         return jsonify({"error": str(e)}), 500
 
 @app.route("/status/<task_id>", methods=["GET"])
-def get_status(task_id):
-    """Get status of a specific task"""
-    if task_id in completed_tasks:
-        return jsonify(completed_tasks[task_id])
-    elif task_id in pending_tasks:
-        task = pending_tasks[task_id]
-        elapsed = (datetime.now() - task["created_at"]).total_seconds() / 60
+async def get_status(task_id):
+    """Get status of a specific task, optionally waiting up to ?wait=N seconds for it to finish"""
+    wait = min(request.args.get("wait", 0, type=float), MAX_STATUS_WAIT)
+    target_id = task_aliases.get(task_id, task_id)
+    if wait > 0 and target_id in completion_events:
+        await wait_for_completion(target_id, wait)
+    
+    snapshot = task_snapshot(task_id)
+    
+    # Tasks completed before a restart are only on disk
+    if snapshot is None and tasks_db is not None:
+        snapshot = (await asyncio.to_thread(load_completed_tasks, [task_id])).get(task_id)
+    if snapshot is None:
+        return jsonify({"error": "Task not found"}), 404
+    
+    # Polls that already saw this state get an empty 304 instead of the same JSON again
+    etag = f'W/"{snapshot["status"]}-{len(snapshot.get("image_urls", ()))}"'
+    if request.headers.get("If-None-Match") == etag:
+        return "", 304, {"ETag": etag}
+    response = jsonify(snapshot)
+    response.headers["ETag"] = etag
+    return response
+
+@app.route("/status/batch", methods=["POST"])
+async def get_status_batch():
+    """Get the status of up to MAX_BATCH_STATUS tasks in one request"""
+    data = await request.get_json(silent=True, cache=False)
+    task_ids = data.get("task_ids") if isinstance(data, dict) else None
+    if not isinstance(task_ids, list) or not all(isinstance(task_id, str) for task_id in task_ids):
+        return jsonify({"error": "task_ids must be a list of strings"}), 400
+    if len(task_ids) > MAX_BATCH_STATUS:
+        return jsonify({"error": f"At most {MAX_BATCH_STATUS} task_ids per request"}), 400
+    
+    snapshots = {task_id: task_snapshot(task_id) for task_id in task_ids}
+    
+    missing = [task_id for task_id, snapshot in snapshots.items() if snapshot is None]
+    if missing and tasks_db is not None:
+        snapshots.update(await asyncio.to_thread(load_completed_tasks, missing))
+    return jsonify({
+        task_id: snapshot if snapshot is not None else {"error": "Task not found"}
+        for task_id, snapshot in snapshots.items()
+    })
+
+def task_snapshot(task_id):
+    """Return what /status reports for an in-memory task or an alias of one, or None"""
+    target_id = task_aliases.get(task_id, task_id)
+    task = completed_tasks.get(target_id)
+    if task is not None:
+        snapshot = task.to_dict()
+    else:
+        task = pending_tasks.get(target_id)
+        if task is None:
+            return None
+        
+        elapsed = (time.monotonic() - task.created_monotonic) / 60
         
         # Check if task has timed out
         if elapsed > MAX_WAIT_MINUTES:
-            task["status"] = "timeout"
-            task["message"] = f"Task timed out after {MAX_WAIT_MINUTES} minutes"
-            
-        return jsonify({
-            "task_id": task_id,
-            "status": task["status"],
-            "prompt": task.get("prompt", ""),
-            "elapsed_minutes": round(elapsed, 1),
-            "message": task.get("message", "")
-        })
-    else:
-        return jsonify({"error": "Task not found"}), 404
+            task.status = "timeout"
+            task.message = f"Task timed out after {MAX_WAIT_MINUTES} minutes"
+        
+        snapshot = {**task.to_dict(), "elapsed_minutes": round(elapsed, 1)}
+    
+    if target_id != task_id:
+        snapshot.update(task_id=task_id, coalesced_to=target_id)
+    return snapshot
+
+def response_task_ids(requested_id, task_id):
+    """Return the task_id fields to report, aliasing a caller-supplied ID to the task that serves it"""
+    if requested_id is None or requested_id == task_id:
+        return {"task_id": task_id}
+    task_aliases[requested_id] = task_id
+    return {"task_id": requested_id, "coalesced_to": task_id}
 
 @app.route("/tasks", methods=["GET"])
-def list_tasks():
+async def list_tasks():
     """List all tasks for debugging"""
     return jsonify({
-        "pending": {k: {**v, "created_at": v["created_at"].isoformat()} for k, v in pending_tasks.items()},
-        "completed": completed_tasks
+        "pending": {k: {**v.to_dict(), "created_at": v.created_at} for k, v in pending_tasks.items()},
+        "completed": {k: v.to_dict() for k, v in completed_tasks.items()}
     })
 
-def send_imagine_command(prompt, task_id):
+def task_in_flight(task_id):
+    """Return whether a task is queued for sending or waiting on Midjourney's reply"""
+    task = pending_tasks.get(task_id)
+    return task is not None and task.status in ("queued", "submitted")
+
+def prompt_hash(prompt):
+    """Return a short hash identifying a prompt regardless of case"""
+    return hashlib.sha256(prompt.casefold().encode()).hexdigest()[:16]
+
+@functools.lru_cache(maxsize=2048)
+def prompt_keywords(prompt):
+    """Return the distinctive leading words of a prompt used to recognize Midjourney's reply"""
+    # Short words such as "a", "in" or "the" appear in most prompts and would match anyone's reply
+    return frozenset(word for word in TOKEN_RE.findall(prompt.casefold())[:8] if len(word) > 3)
+
+def new_session_id():
+    """Return a random UUID4 string, reading os.urandom once per batch of IDs"""
+    if not _session_ids:
+        raw = os.urandom(16 * SESSION_ID_BATCH)
+        _session_ids.extend(str(uuid.UUID(bytes=raw[i:i + 16], version=4)) for i in range(0, len(raw), 16))
+    return _session_ids.popleft()
+
+async def submit_prompt(prompt, task_id):
+    """Send a queued prompt, marking the task failed if the send does not go through"""
+    success, message = await send_imagine_command(prompt, task_id)
+    if not success:
+        task = pending_tasks.get(task_id)
+        if task is not None and task.status == "queued":
+            task.status = "failed"
+            task.error = message
+        # Wake /status long-polls waiting on the queued task
+        event = completion_events.pop(task_id, None)
+        if event is not None:
+            event.set()
+    return success, message
+
+def register_pending(task_id, prompt, future, session_id=None):
+    """Record a sent task and index its prompt so dispatch_message can resolve the future with Midjourney's reply"""
+    pending_tasks[task_id] = Task(
+        task_id=task_id,
+        prompt=prompt,
+        status="submitted",
+        created_at=datetime.now(),
+        created_monotonic=time.monotonic(),
+        session_id=session_id,
+        message="Command sent successfully"
+    )
+    prompt_words = prompt_keywords(prompt)
+    pending_futures[task_id] = (future, prompt_words)
+    for word in prompt_words:
+        token_index[word].add(task_id)
+    prompt_index[prompt_hash(prompt)] = task_id
+
+async def send_imagine_command(prompt, task_id):
     """Send /imagine command using raw Discord API"""
     try:
-        # Prepare headers
-        headers = {
-            "authority": "discord.com",
-            "accept": "*/*",
-            "accept-language": "en-US,en;q=0.9",
-            "content-type": "application/json",
-            "origin": "https://discord.com",
-            "referer": f"https://discord.com/channels/{GUILD_ID}/{CHANNEL_ID}",
-            "user-agent": DISCORD_USER_AGENT,
-            "cookie": DISCORD_COOKIE,
-            "x-super-properties": DISCORD_SUPER_PROPERTIES,
-            "x-discord-locale": "en-US"
-        }
-        
         # Generate unique session ID
-        session_id = str(uuid.uuid4())
+        session_id = new_session_id()
         
-        # Prepare payload for /imagine command
+        # Only the session ID and prompt vary per request
         payload = {
-            "type": 2,  # APPLICATION_COMMAND
-            "application_id": MIDJOURNEY_APP_ID,
-            "guild_id": GUILD_ID,
-            "channel_id": CHANNEL_ID,
+            **PAYLOAD_TEMPLATE,
             "session_id": session_id,
             "data": {
-                "version": IMAGINE_COMMAND_VERSION,
-                "id": IMAGINE_COMMAND_ID,
-                "name": "imagine",
-                "type": 1,
+                **PAYLOAD_TEMPLATE["data"],
                 "options": [
                     {
                         "type": 3,  # STRING
                         "name": "prompt",
                         "value": prompt[:2000]  # Discord limit
                     }
-                ],
-                "application_command": {
-                    "id": IMAGINE_COMMAND_ID,
-                    "application_id": MIDJOURNEY_APP_ID,
-                    "version": IMAGINE_COMMAND_VERSION,
-                    "default_member_permissions": None,
-                    "type": 1,
-                    "nsfw": False,
-                    "name": "imagine",
-                    "description": "Create images with Midjourney",
-                    "dm_permission": True,
-                    "options": [
-                        {
-                            "type": 3,
-                            "name": "prompt",
-                            "description": "A prompt to generate an image.",
-                            "required": True
-                        }
-                    ]
-                },
-                "attachments": []
+                ]
             }
         }
         
-        logger.info(f"📤 Sending request to Discord API...")
-        logger.info(f"🎯 Target: Guild {GUILD_ID}, Channel {CHANNEL_ID}")
-        logger.info(f"💬 Prompt: {prompt}")
-        
-        # Send the request
-        response = requests.post(
-            "https://discord.com/api/v9/interactions",
-            headers=headers,
-            json=payload,
-            timeout=30
-        )
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("📤 Sending request to Discord API...")
+            logger.debug("🎯 Target: Guild %s, Channel %s", GUILD_ID, CHANNEL_ID)
+            logger.debug("💬 Prompt: %s", prompt)
         
-        logger.info(f"📬 Response status: {response.status_code}")
+        # Send the request over the shared session, retrying rate limits and server errors
+        for attempt in range(MAX_SEND_ATTEMPTS):
+            last_attempt = attempt == MAX_SEND_ATTEMPTS - 1
+            try:
+                async with SEND_SLOTS, get_session().post(
+                    "https://discord.com/api/v9/interactions",
+                    headers=HEADERS,
+                    data=orjson.dumps(payload)
+                ) as response:
+                    status = response.status
+                    response_text = await response.text()
+                    retry_after = response.headers.get("Retry-After")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if last_attempt:
+                    raise
+                delay = min(30, 2 ** attempt) + random.random()
+                logger.warning("⚠️ Network error (%r), retrying in %.1fs", e, delay)
+                await asyncio.sleep(delay)
+                continue
+            
+            logger.debug("📬 Response status: %s", status)
+            
+            if last_attempt:
+                break
+            if status == 429:
+                try:
+                    delay = float(orjson.loads(response_text)["retry_after"])
+                except (orjson.JSONDecodeError, KeyError, TypeError, ValueError):
+                    # The header may be missing or malformed too
+                    try:
+                        delay = float(retry_after or 1.0)
+                    except ValueError:
+                        delay = 1.0
+                delay += random.random() * 0.25
+                logger.warning("⏳ Rate limited, retrying in %.1fs", delay)
+                await asyncio.sleep(delay)
+                continue
+            if 500 <= status < 600:
+                delay = min(30, 2 ** attempt) + random.random()
+                logger.warning("⚠️ Discord returned %s, retrying in %.1fs", status, delay)
+                await asyncio.sleep(delay)
+                continue
+            break
         
-        if response.status_code == 204:
+        if status == 204:
             # Success - command sent
-            logger.info(f"✅ Successfully sent /imagine command")
+            logger.info("✅ Successfully sent /imagine command")
             
-            pending_tasks[task_id] = {
-                "prompt": prompt,
-                "status": "submitted",
-                "created_at": datetime.now(),
-                "session_id": session_id,
-                "message": "Command sent successfully"
-            }
+            # Register for the reply and make sure the channel is being watched
+            register_pending(task_id, prompt, asyncio.get_running_loop().create_future(), session_id)
+            completion_events.setdefault(task_id, asyncio.Event())
+            spawn(wait_for_response(task_id))
+            ensure_watcher()
             
             return True, "Command sent successfully to Midjourney"
             
-        elif response.status_code == 401:
+        elif status == 401:
             error_msg = "Authentication failed - Discord cookie may be expired"
-            logger.error(f"❌ {error_msg}")
+            logger.error("❌ %s", error_msg)
             return False, error_msg
             
-        elif response.status_code == 403:
+        elif status == 403:
             error_msg = "Forbidden - Bot may not have permissions or user not in server"
-            logger.error(f"❌ {error_msg}")
+            logger.error("❌ %s", error_msg)
             return False, error_msg
             
-        elif response.status_code == 429:
+        elif status == 429:
             error_msg = "Rate limited - too many requests"
-            logger.error(f"❌ {error_msg}")
+            logger.error("❌ %s", error_msg)
             return False, error_msg
             
         else:
             # Other error
-            error_text = response.text[:500] if response.text else "No response body"
-            error_msg = f"Discord API error {response.status_code}: {error_text}"
-            logger.error(f"❌ {error_msg}")
+            error_text = response_text[:500] if response_text else "No response body"
+            error_msg = f"Discord API error {status}: {error_text}"
+            logger.error("❌ %s", error_msg)
             
-            pending_tasks[task_id] = {
-                "prompt": prompt,
-                "status": "failed",
-                "created_at": datetime.now(),
-                "error": error_msg
-            }
+            pending_tasks[task_id] = Task(
+                task_id=task_id,
+                prompt=prompt,
+                status="failed",
+                created_at=datetime.now(),
+                created_monotonic=time.monotonic(),
+                error=error_msg
+            )
             
             return False, error_msg
             
-    except requests.exceptions.Timeout:
+    except asyncio.TimeoutError:
         error_msg = "Request timed out"
-        logger.error(f"❌ {error_msg}")
+        logger.error("❌ %s", error_msg)
         return False, error_msg
         
     except Exception as e:
         error_msg = f"Unexpected error: {str(e)}"
-        logger.error(f"❌ {error_msg}")
+        logger.error("❌ %s", error_msg)
         return False, error_msg
 
-# Optional: Cleanup old tasks
-def cleanup_old_tasks():
-    """Remove tasks older than 24 hours"""
-    cutoff = datetime.now() - timedelta(hours=24)
+def snowflake_time(snowflake):
+    """Convert a Discord snowflake ID to a naive local datetime"""
+    return datetime.fromtimestamp(((int(snowflake) >> 22) + DISCORD_EPOCH_MS) / 1000)
+
+def time_snowflake(dt):
+    """Return the smallest Discord snowflake ID created at a naive local datetime"""
+    return (int(dt.timestamp() * 1000) - DISCORD_EPOCH_MS) << 22
+
+def ensure_watcher():
+    """Start the channel watcher if it is not already running"""
+    global _watcher
+    if _watcher is None or _watcher.done():
+        _watcher = spawn(watch_channel())
+
+async def watch_channel():
+    """Fetch new channel messages once per interval on behalf of every pending task"""
+    logger.info("👀 Watching channel for Midjourney responses")
     
-    # Clean pending tasks
-    old_pending = [k for k, v in pending_tasks.items() if v["created_at"] < cutoff]
-    for task_id in old_pending:
-        del pending_tasks[task_id]
+    # Only ask Discord for messages newer than the last one seen, starting at the oldest pending task
+    oldest = min(pending_tasks[task_id].created_at for task_id in pending_futures if task_id in pending_tasks)
+    last_seen_id = time_snowflake(oldest)
+    interval = CHECK_INTERVAL
     
-    # Clean completed tasks
-    old_completed = [k for k, v in completed_tasks.items() 
-                    if datetime.fromisoformat(v.get("completed_at", "1970-01-01")) < cutoff]
-    for task_id in old_completed:
-        del completed_tasks[task_id]
+    while pending_futures:
+        await asyncio.sleep(interval + random.random())
+        messages, last_seen_id = await fetch_new_messages(last_seen_id)
+        
+        midjourney_active = False
+        for message in messages:
+            if message["author"]["id"] == MIDJOURNEY_USER_ID:
+                midjourney_active = True
+                if message.get("attachments"):
+                    dispatch_message(message)
+        
+        if midjourney_active:
+            interval = MIN_CHECK_INTERVAL
+        else:
+            interval = min(interval * 1.2, MAX_CHECK_INTERVAL)
+    logger.info("💤 No pending tasks, channel watcher stopped")
+
+async def fetch_new_messages(after):
+    """Return channel messages newer than the after ID, oldest first, and the new cursor"""
+    global channel_checks
+    messages = []
+    while True:
+        channel_checks += 1
+        try:
+            params = {"limit": MESSAGES_PAGE_SIZE, "after": after}
+            async with get_session().get(MESSAGES_URL, headers=HEADERS, params=params) as response:
+                rate_limit_wait = rate_limit_delay(response)
+                if response.status == 200:
+                    page = await response.json(loads=orjson.loads)
+                else:
+                    logger.warning("⚠️ Could not read channel messages: HTTP %s", response.status)
+                    page = None
+        except Exception as e:
+            logger.error("❌ Error reading channel messages: %s", e)
+            break
+        
+        # Wait out an exhausted rate limit bucket instead of reading into a 429
+        if rate_limit_wait:
+            logger.debug("⏳ Channel reads rate limited, pausing %.1fs", rate_limit_wait)
+            await asyncio.sleep(rate_limit_wait)
+        if not page:
+            break
+        # Discord returns each page newest first
+        messages.extend(reversed(page))
+        after = max(int(message["id"]) for message in page)
+        
+        # A full page means more messages may be waiting
+        if len(page) < MESSAGES_PAGE_SIZE:
+            break
+    return messages, after
+
+def rate_limit_delay(response):
+    """Return how long Discord asks us to wait before using this rate limit bucket again"""
+    try:
+        if response.status == 429:
+            return float(response.headers.get("Retry-After", 1.0))
+        if response.headers.get("X-RateLimit-Remaining") == "0":
+            return float(response.headers.get("X-RateLimit-Reset-After", 1.0))
+    except ValueError:
+        return 1.0
+    return 0
+
+def dispatch_message(message):
+    """Resolve the future of the pending task a Midjourney message answers"""
+    logger.debug("🤖 Midjourney message: %.50s", message.get("content", ""))
+    message_content = message.get("content", "").casefold()
+    
+    # Progress updates carry a percentage, e.g. "(42%)", and too-short content cannot name a prompt
+    if len(message_content) < 3 or "%)" in message_content:
+        return
+    
+    sent_at = snowflake_time(message["id"])
+    image_urls = [
+        attachment["url"] for attachment in message["attachments"]
+        if IMAGE_FILENAME_RE.search(attachment["filename"])
+    ]
+    if not image_urls:
+        return
+    
+    result = {"message_id": message["id"], "image_urls": image_urls}
+    
+    # An echoed prompt identical to a submitted one identifies its task exactly,
+    # with or without the --params Midjourney may append to it
+    echoed = BOLD_PROMPT_RE.search(message_content)
+    if echoed:
+        echoed_prompt = echoed.group(1).strip()
+        echoed_text = echoed_prompt.split(" --", 1)[0].rstrip()
+        for candidate in (echoed_prompt, echoed_text):
+            task_id = prompt_index.get(prompt_hash(candidate))
+            if awaiting_reply(task_id, sent_at):
+                pending_futures[task_id][0].set_result(result)
+                return
+        # A reply to someone else's prompt may only match on the words of its own echo
+        message_words = set(TOKEN_RE.findall(echoed_text))
+    else:
+        # Midjourney wraps the prompt in **bold**, so tokenize on word characters rather than whitespace
+        message_words = set(TOKEN_RE.findall(message_content))
+    
+    # Otherwise fall back to word overlap, counted only for tasks sharing at least one word
+    shared = Counter()
+    for word in message_words:
+        shared.update(token_index.get(word, ()))
     
-    if old_pending or old_completed:
-        logger.info(f"🧹 Cleaned up {len(old_pending)} pending and {len(old_completed)} completed tasks")
+    matches = []
+    for task_id, count in shared.items():
+        if awaiting_reply(task_id, sent_at) and count >= min(2, len(pending_futures[task_id][1])):
+            matches.append(pending_tasks[task_id])
+    
+    # The oldest matching task wins, as Midjourney answers prompts in submission order
+    if matches:
+        task_info = min(matches, key=lambda task: task.created_monotonic)
+        pending_futures[task_info.task_id][0].set_result(result)
+
+def awaiting_reply(task_id, sent_at):
+    """Return whether a task is still waiting for a reply and was submitted before sent_at"""
+    entry = pending_futures.get(task_id)
+    task_info = pending_tasks.get(task_id)
+    return entry is not None and not entry[0].done() and task_info is not None and task_info.created_at <= sent_at
+
+async def wait_for_response(task_id):
+    """Wait for Midjourney's reply to a task and move it to completed tasks"""
+    future, prompt_words = pending_futures[task_id]
+    try:
+        result = await asyncio.wait_for(future, timeout=MAX_WAIT_MINUTES * 60)
+    except asyncio.TimeoutError:
+        task = pending_tasks.get(task_id)
+        if task is not None:
+            task.status = "timeout"
+            task.message = f"Task timed out after {MAX_WAIT_MINUTES} minutes"
+        logger.warning("⏰ Task %s timed out waiting for Midjourney", task_id)
+    else:
+        # Move the task in one step so /status never sees it missing from both stores
+        task = pending_tasks.pop(task_id, None)
+        if task is not None:
+            task.status = "completed"
+            task.message_id = result["message_id"]
+            task.image_urls = result["image_urls"]
+            task.completed_at = datetime.now()
+            completed_tasks[task_id] = task
+        if tasks_db is not None and task is not None:
+            await asyncio.to_thread(save_completed_task, task)
+        logger.info("🎨 Task %s completed with %d images", task_id, len(result["image_urls"]))
+    finally:
+        # Unregister only what this waiter registered, in case the task_id was submitted again
+        if pending_futures.get(task_id, (None,))[0] is future:
+            del pending_futures[task_id]
+        for word in prompt_words:
+            postings = token_index.get(word)
+            if postings is not None:
+                postings.discard(task_id)
+                if not postings:
+                    del token_index[word]
+        # Wake /status long-polls once the final state is stored
+        event = completion_events.pop(task_id, None)
+        if event is not None:
+            event.set()
+
+async def wait_for_completion(task_id, timeout):
+    """Wait up to timeout seconds for a pending task to complete or time out"""
+    event = completion_events.get(task_id)
+    if event is None:
+        return
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
 
 if __name__ == "__main__":
     logger.info("🚀 Starting Midjourney Raw API Bridge...")
-    logger.info(f"📍 Target Channel: {CHANNEL_ID}")
-    logger.info(f"🏠 Target Guild: {GUILD_ID}")
-    logger.info(f"🍪 Cookie configured: {'Yes' if DISCORD_COOKIE else 'No'}")
+    logger.info("📍 Target Channel: %s", CHANNEL_ID)
+    logger.info("🏠 Target Guild: %s", GUILD_ID)
+    logger.info("🍪 Cookie configured: %s", "Yes" if DISCORD_COOKIE else "No")
     
-    port = int(os.environ.get("PORT", 10000))
-    app.run(host="0.0.0.0", port=port, debug=False)
+    # The HTTP server, the Discord session and the channel watcher all share this one loop
+    config = Config()
+    config.bind = [f"0.0.0.0:{int(os.environ.get('PORT', 10000))}"]
+    run = uvloop.run if uvloop is not None else asyncio.run
+    run(serve(app, config))
@@ -0,0 +1,60 @@
+import asyncio
+import unittest
+from datetime import datetime, timedelta
+
+import app
+
+
+def midjourney_message(content, seconds_from_now=1):
+    """Build a channel message as Discord returns it, posted a little after now"""
+    sent_at = datetime.now() + timedelta(seconds=seconds_from_now)
+    return {
+        "id": str(app.time_snowflake(sent_at)),
+        "author": {"id": app.MIDJOURNEY_USER_ID},
+        "content": content,
+        "attachments": [{"url": "https://cdn.discordapp.com/grid_0.png", "filename": "grid_0.png"}]
+    }
+
+
+class DispatchMessageTest(unittest.IsolatedAsyncioTestCase):
+    def submit(self, task_id, prompt):
+        """Register a pending task the way send_imagine_command does"""
+        future = self.loop.create_future()
+        app.register_pending(task_id, prompt, future)
+        return future
+
+    async def asyncSetUp(self):
+        self.loop = asyncio.get_running_loop()
+
+    def tearDown(self):
+        for state in (app.pending_tasks, app.prompt_index, app.pending_futures, app.token_index, app.completion_events):
+            state.clear()
+
+    def test_foreign_reply_sharing_only_short_words_is_ignored(self):
+        future = self.submit("cat", "a cat in the park")
+        app.dispatch_message(midjourney_message("**a house in the woods --v 6** - <@1> (fast)"))
+        self.assertFalse(future.done())
+
+    def test_exact_echo_resolves_task(self):
+        future = self.submit("fox", "a red fox in snow")
+        app.dispatch_message(midjourney_message("**A red fox in snow** - <@1> (fast)"))
+        self.assertEqual(future.result()["image_urls"], ["https://cdn.discordapp.com/grid_0.png"])
+
+    def test_echo_with_trailing_params_resolves_task(self):
+        future = self.submit("fox", "a red fox in snow")
+        app.dispatch_message(midjourney_message("**a red fox in snow --v 6.0** - <@1> (fast)"))
+        self.assertTrue(future.done())
+
+    def test_words_outside_a_foreign_echo_do_not_count(self):
+        future = self.submit("lighthouse", "strong variations of a lighthouse")
+        app.dispatch_message(midjourney_message("**a harbor at dawn** - Variations (Strong) by <@1> (fast)"))
+        self.assertFalse(future.done())
+
+    def test_progress_updates_are_skipped(self):
+        future = self.submit("fox", "a red fox in snow")
+        app.dispatch_message(midjourney_message("**a red fox in snow** - <@1> (42%) (fast)"))
+        self.assertFalse(future.done())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+import time
+import asyncio
+import unittest
+from datetime import datetime
+from unittest import mock
+
+import app
+
+
+class FakeResponse:
+    def __init__(self, status, body=None):
+        self.status = status
+        self.headers = {}
+        self._body = body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def text(self):
+        return ""
+
+    async def json(self, **kwargs):
+        return self._body
+
+
+class FakeDiscord:
+    """Accepts every /imagine and reports an empty channel"""
+
+    def __init__(self):
+        self.interactions = 0
+
+    def post(self, url, **kwargs):
+        self.interactions += 1
+        return FakeResponse(204)
+
+    def get(self, url, **kwargs):
+        return FakeResponse(200, [])
+
+
+class GenerateTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.discord = FakeDiscord()
+        for patcher in (
+            mock.patch.object(app, "get_session", lambda: self.discord),
+            mock.patch.object(app, "MISSING_ENV_VARS", [])
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = app.app.test_client()
+
+    async def asyncTearDown(self):
+        for task in list(app._background_tasks):
+            task.cancel()
+        await asyncio.gather(*list(app._background_tasks), return_exceptions=True)
+        for state in (app.pending_tasks, app.completed_tasks, app.prompt_index, app.task_aliases,
+                      app.pending_futures, app.token_index, app.completion_events):
+            state.clear()
+
+    async def generate(self, task_id, prompt="a red fox in snow"):
+        response = await self.client.post("/generate", json={"prompt": prompt, "task_id": task_id})
+        return await response.get_json()
+
+    async def status(self, task_id):
+        response = await self.client.get(f"/status/{task_id}")
+        return response.status_code, await response.get_json()
+
+    async def test_joined_submission_keeps_callers_task_id(self):
+        first, second = await asyncio.gather(self.generate("mine-1"), self.generate("mine-2"))
+        self.assertEqual(self.discord.interactions, 1)
+        self.assertEqual(first["task_id"], "mine-1")
+        self.assertEqual(second["task_id"], "mine-2")
+        self.assertEqual(second["coalesced_to"], "mine-1")
+
+        status_code, snapshot = await self.status("mine-2")
+        self.assertEqual(status_code, 200)
+        self.assertEqual(snapshot["task_id"], "mine-2")
+        self.assertEqual(snapshot["coalesced_to"], "mine-1")
+        self.assertEqual(snapshot["status"], "submitted")
+
+    async def test_repeated_prompt_keeps_callers_task_id(self):
+        await self.generate("first")
+        joined = await self.generate("second")
+        self.assertEqual((joined["task_id"], joined["coalesced_to"]), ("second", "first"))
+
+        future, _ = app.pending_futures["first"]
+        future.set_result({"message_id": "1", "image_urls": ["https://cdn.discordapp.com/grid_0.png"]})
+        await app.wait_for_completion("first", 1)
+        reused = await self.generate("third")
+        self.assertEqual(self.discord.interactions, 1)
+        self.assertEqual((reused["task_id"], reused["status"]), ("third", "completed"))
+
+        for task_id in ("second", "third"):
+            status_code, snapshot = await self.status(task_id)
+            self.assertEqual(status_code, 200)
+            self.assertEqual(snapshot["task_id"], task_id)
+            self.assertEqual(snapshot["image_urls"], ["https://cdn.discordapp.com/grid_0.png"])
+
+    async def test_task_completed_before_restart_is_not_resent(self):
+        with mock.patch.object(app, "tasks_db", app.open_tasks_db(":memory:")):
+            app.save_completed_task(app.Task(
+                task_id="stored",
+                prompt="a red fox in snow",
+                status="completed",
+                created_at=datetime.now(),
+                created_monotonic=time.monotonic(),
+                message_id="1",
+                image_urls=["https://cdn.discordapp.com/grid_0.png"],
+                completed_at=datetime.now()
+            ))
+            reused = await self.generate("stored", prompt="a blue whale")
+        self.assertEqual(self.discord.interactions, 0)
+        self.assertEqual(reused["status"], "completed")
+        self.assertEqual(reused["image_urls"], ["https://cdn.discordapp.com/grid_0.png"])
+
+    async def test_oversized_bodies_are_rejected(self):
+        for size in (app.MAX_GENERATE_BYTES, app.app.config["MAX_CONTENT_LENGTH"]):
+            body = b'{"prompt": "' + b"x" * size + b'"}'
+            response = await self.client.post("/generate", data=body, headers={"Content-Type": "application/json"})
+            self.assertEqual(response.status_code, 413)
+        self.assertEqual(self.discord.interactions, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()